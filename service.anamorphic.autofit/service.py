@@ -5,29 +5,227 @@
 
 import xbmc
 import xbmcaddon
+import xbmcvfs
 import json
+import os
 import time
 import re
+import socket
+import threading
 import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from requests.adapters import HTTPAdapter
+
+# orjson is an optional, faster JSON codec; the standard library is used without it.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Shared JSON-RPC serializers. Compact separators keep the payload Kodi parses small.
+# orjson always emits compact output, but as bytes, while executeJSONRPC wants a str.
+if orjson is not None:
+    def _JSON_ENCODE(obj):
+        return orjson.dumps(obj).decode('utf-8')
+    _JSON_DECODE = orjson.loads
+else:
+    _JSON_ENCODE = json.JSONEncoder(separators=(',', ':')).encode
+    _JSON_DECODE = json.JSONDecoder().decode
+
+# Player.SetViewMode always has the same shape, so the request is filled in from a
+# template instead of being serialized from a dict.
+_SET_VIEWMODE_TMPL = '{"jsonrpc":"2.0","id":1,"method":"Player.SetViewMode","params":{"viewmode":{"zoom":%.4f,"pixelratio":%.4f}}}'
+
+# The scraping patterns are compiled once at import instead of on every playback.
+# They are bytes patterns, so response bodies are searched without decoding them.
+# _RE_JS_URLS captures the first movie URL from the quicksearch `var urls = new Array(...)`
+# snippet; _RE_ASPECT captures the "Aspect ratio: X.XX:1" value on the movie page.
+# Each pattern starts with a fixed anchor string, which is located with bytes.find
+# before the regex is run at that position (see _search_anchored).
+_JS_URLS_ANCHOR = b"var urls = new Array("
+_RE_JS_URLS = re.compile(rb"var urls = new Array\('([^']+)'")
+_ASPECT_ANCHOR = b'Aspect ratio:'
+_RE_ASPECT = re.compile(rb'Aspect ratio:\s*(\d+\.\d{2}):1')
+
+# Bytes carried over between streamed chunks; comfortably longer than any match.
+_STREAM_OVERLAP = 64
+
+# A streamed page closed before its end takes its connection down with it. If no
+# more than this many bytes are left after the match, they are read out instead,
+# so the keep-alive connection goes back to the pool.
+_STREAM_DRAIN_MAX = 64 * 1024
+
+# Aspect ratio of a 16:9 container, and the range a measured container AR must
+# fall in to be treated as 16:9.
+_SIXTEEN_NINE = 16.0 / 9.0
+_CONTAINER_MIN, _CONTAINER_MAX = 1.77, 1.79
+
+# (connect, read) timeouts in seconds for blu-ray.com requests. A short connect
+# timeout fails fast when the site is unreachable; reads on a live connection
+# are given more time.
+HTTP_TIMEOUT = (5, 10)
+
+# Kodi's video player always uses this id, so stream details can be requested
+# in the same JSON-RPC batch that lists the active players.
+VIDEO_PLAYER_ID = 1
+
+# Seconds to wait for a running aspect ratio lookup before giving up on it.
+LOOKUP_TIMEOUT_S = 15
+
+# How often, in seconds, a pending lookup checks whether Kodi is shutting down.
+LOOKUP_WAIT_SLICE_S = 0.1
+
+# A title that blu-ray.com has no aspect ratio for is not searched again for this long.
+AR_CACHE_MISS_TTL_S = 24 * 60 * 60
+
+# Longest pause, in seconds, between lookups after repeated network failures,
+# and between DNS probes while blu-ray.com cannot be resolved.
+NET_BACKOFF_MAX_S = 300
+
+# Returned by the scraper when blu-ray.com answered but had no usable result, as
+# opposed to None for a lookup that failed or was skipped and may succeed later.
+_NO_MATCH = object()
+
+# Upper bound on the number of titles kept in the on-disk aspect ratio cache.
+AR_CACHE_MAX_ENTRIES = 2000
+
+def _search_anchored(data, pattern, anchor):
+    """
+    Returns the first match of `pattern` in `data`, where `pattern` begins with the
+    literal `anchor`. The anchor is located with bytes.find, a tight C loop, and
+    the regex is only matched at those positions instead of scanning the body.
+    """
+    idx = data.find(anchor)
+    while idx >= 0:
+        match = pattern.match(data, idx)
+        if match:
+            return match
+        idx = data.find(anchor, idx + 1)
+    return None
+
+def _compute_view_mode(video_ar, content_ar, target_ar):
+    """
+    The Smart Zoom calculation. Returns a (zoom, pixel_ratio) tuple, or None if
+    the content is not wider than the container and no adjustment is needed.
+    """
+    if content_ar <= video_ar + 0.01:
+        return None
+    # Zoom to the content's width, but never beyond the screen's own aspect
+    # ratio, so content wider than the screen is not cropped.
+    effective_ar = min(content_ar, target_ar)
+    zoom = effective_ar / video_ar
+    pixel_ratio = _SIXTEEN_NINE / target_ar
+    return zoom, pixel_ratio
+
+def _info_label_int(label):
+    """
+    Reads a numeric InfoLabel, returning 0 when it is empty. Kodi formats these
+    numbers for display (e.g. "1,920"), so everything but the digits is dropped.
+    """
+    digits = ''.join(c for c in xbmc.getInfoLabel(label) if c.isdigit())
+    return int(digits) if digits else 0
+
+def _info_label_float(label):
+    """Reads a decimal InfoLabel, returning None when it is empty or not a number."""
+    try:
+        return float(xbmc.getInfoLabel(label))
+    except ValueError:
+        return None
+
+class AnamorphicSettingsMonitor(xbmc.Monitor):
+    """
+    Keeps the service alive and flags when the addon settings have been changed,
+    so the player only re-reads them when necessary.
+    """
+    def __init__(self):
+        super(AnamorphicSettingsMonitor, self).__init__()
+        self.settings_dirty = False
+
+    def onSettingsChanged(self):
+        self.settings_dirty = True
 
 class AnamorphicPlayerMonitor(xbmc.Player):
     """
     A custom Kodi Player class that listens for playback events and triggers
     the anamorphic adjustment logic.
     """
-    def __init__(self):
+    def __init__(self, monitor):
         super(AnamorphicPlayerMonitor, self).__init__()
-        self.addon = xbmcaddon.Addon()
-        self.session = requests.Session()
+        self._monitor = monitor
+        self._refresh_debug_flag()
+        self._reload_settings()
+
+        # A single Session is kept for the whole service lifetime, so the movie page
+        # fetch reuses the search request's keep-alive TLS connection to blu-ray.com.
+        # Later playbacks reuse it too while the server keeps it open, provided the
+        # movie page could be drained (see _search_streamed).
+        # A User-Agent header is crucial to mimic a real web browser,
+        # preventing the server from blocking our automated request.
+        self._http = requests.Session()
+        self._http.headers.update({'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/18.6 Safari/605.1.15'})
+        self._http.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=4))
+
+        profile_dir = xbmcvfs.translatePath(self.addon.getAddonInfo('profile'))
+        self._ar_cache_path = os.path.join(profile_dir, 'ar_cache.json')
+        self._ar_cache = self._load_ar_cache()
+        self._net_fail_count = 0
+        self._net_cooldown_until = 0.0
+        self._net_ok = True
+        self._net_probe_fail_count = 0
+        self._net_reprobe_at = 0.0
+
+        # Set by shutdown(), so a running lookup stops before its next request.
+        self._stopping = threading.Event()
+
+        # Lookups run on a worker thread, so the player callback can keep an eye on
+        # playback and shutdown while it waits for the network. Only one lookup is
+        # ever awaited at a time, so a single worker is enough. It is also the only
+        # thread that touches the aspect ratio cache and the network backoff state
+        # above, so neither needs a lock.
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # The DNS probe runs there too: getaddrinfo is not bounded by any socket
+        # timeout, so doing it here could stall service startup.
+        self._executor.submit(self._probe_network)
         self.log("Service initialized")
 
-    def log(self, msg, level=xbmc.LOGINFO):
+    def log(self, msg, *args, level=xbmc.LOGINFO):
         """
         A helper function for consistent and identifiable logging. All log messages
         from this addon will be prefixed with '[service.anamorphic.autofit]'.
+        Arguments are %-formatted into `msg` only when the message is actually
+        logged, so debug messages cost next to nothing while debug logging is off
+        (see _refresh_debug_flag).
         """
+        if level == xbmc.LOGDEBUG and not self._debug:
+            return
+        if args:
+            msg = msg % args
         xbmc.log(f"[service.anamorphic.autofit] {msg}", level=level)
 
+    def _refresh_debug_flag(self):
+        """
+        Caches whether Kodi's debug logging is enabled. This is refreshed at the
+        start of every playback, so turning debug logging on takes effect
+        without restarting Kodi.
+        """
+        self._debug = xbmc.getCondVisibility('System.GetBool(debug.showloginfo)')
+
+    def _reload_settings(self):
+        """
+        Reads and parses the addon settings. They are cached on the instance and
+        only re-read after the settings monitor reports a change.
+        """
+        # A fresh Addon instance is needed to see values changed since startup.
+        self.addon = xbmcaddon.Addon()
+        self._enable_autofit = self.addon.getSettingBool('enable_autofit')
+        try:
+            self._target_screen_ar = float(self.addon.getSetting('target_ar'))
+            self.log("Using Target Screen AR from settings: %s", self._target_screen_ar, level=xbmc.LOGDEBUG)
+        except (ValueError, TypeError):
+            self._target_screen_ar = 2.40
+            self.log("Could not parse Target AR setting. Falling back to default: %s", self._target_screen_ar, level=xbmc.LOGWARNING)
+
     def execute_json_rpc(self, method, params):
         """
         A centralized wrapper for executing Kodi's JSON-RPC commands.
@@ -41,81 +239,282 @@ class AnamorphicPlayerMonitor(xbmc.Player):
                 "params": params,
                 "id": 1
             }
-            response_str = xbmc.executeJSONRPC(json.dumps(request))
-            response = json.loads(response_str)
+            response_str = xbmc.executeJSONRPC(_JSON_ENCODE(request))
+            response = _JSON_DECODE(response_str)
             if "error" in response:
-                self.log(f"JSON-RPC Error on {method}: {response['error']}", level=xbmc.LOGERROR)
+                self.log("JSON-RPC Error on %s: %s", method, response['error'], level=xbmc.LOGERROR)
                 return None
             return response.get("result")
         except Exception as e:
-            self.log(f"Failed to execute JSON-RPC {method}: {e}", level=xbmc.LOGERROR)
+            self.log("Failed to execute JSON-RPC %s: %s", method, e, level=xbmc.LOGERROR)
             return None
 
-    def _get_aspect_ratio_from_bluray_com(self, title, year):
+    def _set_view_mode(self, zoom, pixel_ratio):
         """
-        Searches blu-ray.com and scrapes the aspect ratio. It uses an efficient
-        POST request and requires both a title and a year for accuracy.
+        Applies a custom zoom and pixel ratio through Player.SetViewMode.
+        Returns True on success; errors are logged like in execute_json_rpc.
+        """
+        try:
+            response = _JSON_DECODE(xbmc.executeJSONRPC(_SET_VIEWMODE_TMPL % (zoom, pixel_ratio)))
+            if "error" in response:
+                self.log("JSON-RPC Error on Player.SetViewMode: %s", response['error'], level=xbmc.LOGERROR)
+                return False
+            return True
+        except Exception as e:
+            self.log("Failed to execute JSON-RPC Player.SetViewMode: %s", e, level=xbmc.LOGERROR)
+            return False
+
+    def execute_json_rpc_batch(self, calls):
+        """
+        Executes several JSON-RPC commands in a single executeJSONRPC round trip.
+        `calls` is a list of (method, params) tuples. Returns a dict mapping the
+        1-based position of each call to its result, or to None if it failed.
+        """
+        try:
+            request = [
+                {"jsonrpc": "2.0", "method": method, "params": params, "id": call_id}
+                for call_id, (method, params) in enumerate(calls, 1)
+            ]
+            response_str = xbmc.executeJSONRPC(_JSON_ENCODE(request))
+            responses = _JSON_DECODE(response_str)
+            if isinstance(responses, dict):
+                self.log("JSON-RPC batch rejected: %s", responses.get('error'), level=xbmc.LOGERROR)
+                return {}
+            results = {}
+            methods = {call["id"]: call["method"] for call in request}
+            for response in responses:
+                call_id = response.get("id")
+                if "error" in response:
+                    self.log("JSON-RPC Error on %s: %s", methods.get(call_id), response['error'], level=xbmc.LOGERROR)
+                    results[call_id] = None
+                else:
+                    results[call_id] = response.get("result")
+            return results
+        except Exception as e:
+            self.log("Failed to execute JSON-RPC batch: %s", e, level=xbmc.LOGERROR)
+            return {}
+
+    def _load_ar_cache(self):
+        """
+        Loads the persistent (title, year) -> aspect ratio cache from the addon
+        profile folder. A missing or corrupt file simply yields an empty cache.
+        """
+        try:
+            with open(self._ar_cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            # Entries are only kept if they have the expected shape; anything else
+            # would break lookups later on.
+            return OrderedDict(
+                (key, entry) for key, entry in data.items()
+                if isinstance(entry, dict) and "ar" in entry and "ts" in entry
+            )
+        except FileNotFoundError:
+            return OrderedDict()
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            self.log("Could not load aspect ratio cache, starting empty: %s", e, level=xbmc.LOGWARNING)
+            return OrderedDict()
+
+    def _save_ar_cache(self):
+        """
+        Writes the cache back to disk. The data is written to a temporary file
+        first and then swapped in with os.replace, so a crash mid-write can
+        never leave a truncated cache behind.
+        """
+        tmp_path = self._ar_cache_path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self._ar_cache_path), exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._ar_cache, f)
+            os.replace(tmp_path, self._ar_cache_path)
+        except OSError as e:
+            self.log("Could not write aspect ratio cache: %s", e, level=xbmc.LOGWARNING)
+
+    def _lookup_aspect_ratio(self, title, year, cancelled=None):
+        """
+        Returns the content aspect ratio for a title, consulting the on-disk
+        cache before going to the network. Successful scrapes are stored, and
+        the cache is trimmed to AR_CACHE_MAX_ENTRIES in least-recently-used order.
+        Titles blu-ray.com has no result for are remembered as misses (ar=None)
+        for AR_CACHE_MISS_TTL_S, so they are not searched on every playback.
+        The movie page URL is cached alongside, so a retried miss goes straight
+        to the movie page instead of searching again.
         """
         if not title or not year:
             self.log("Title or year is missing. Bailing out of web search for accuracy.", level=xbmc.LOGWARNING)
             return None
 
-        search_term = f"{title} {year}"
+        # TV shows are searched by their series title, so every episode after the
+        # first one of a show is a cache hit.
+        key = f"{title.strip().lower()}|{year}"
+        entry = self._ar_cache.get(key)
+        if entry is not None:
+            self._ar_cache.move_to_end(key)
+        if entry is not None and (entry["ar"] is not None or time.time() - entry["ts"] < AR_CACHE_MISS_TTL_S):
+            self.log("Aspect ratio cache hit for '%s': %s", key, entry['ar'], level=xbmc.LOGDEBUG)
+            return entry["ar"]
 
-        # A User-Agent header is crucial to mimic a real web browser,
-        # preventing the server from blocking our automated request.
-        headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/18.6 Safari/605.1.15'}
-        self.session.headers.update(headers)
+        known_url = entry.get("url") if entry is not None else None
+        aspect_ratio, movie_url = self._get_aspect_ratio_from_bluray_com(title, year, cancelled, known_url)
+        if aspect_ratio is None:
+            if known_url is not None and movie_url != known_url:
+                # The cached movie page went stale, so it must not be retried even
+                # though the fresh search did not produce a result either.
+                entry["url"] = movie_url
+                self._save_ar_cache()
+            return None
+        if aspect_ratio is _NO_MATCH:
+            aspect_ratio = None
 
-        self.log(f"Attempting online search with term: '{search_term}'")
+        self._ar_cache[key] = {"ar": aspect_ratio, "url": movie_url, "ts": time.time(), "source": "bluray.com"}
+        self._ar_cache.move_to_end(key)
+        while len(self._ar_cache) > AR_CACHE_MAX_ENTRIES:
+            self._ar_cache.popitem(last=False)
+        self._save_ar_cache()
+        return aspect_ratio
+
+    def _probe_network(self):
+        """
+        Checks with a single DNS query whether blu-ray.com can be reached at all.
+        Offline setups then skip lookups instead of waiting for connection
+        timeouts on every playback.
+        """
         try:
-            # NON-OBVIOUS CHOICE: This uses a direct POST request to the search API,
-            # which returns a small, fast, and easy-to-parse JavaScript snippet
-            # instead of a full HTML page. This is much more efficient.
-            post_url = 'https://www.blu-ray.com/search/quicksearch.php'
-            post_data = {
-                'section': 'bluraymovies',
-                'userid': '-1',
-                'country': 'US',
-                'keyword': search_term
-            }
-            response = self.session.post(post_url, data=post_data, timeout=10)
-            response.raise_for_status() # Raise an exception for bad status codes (4xx or 5xx)
-            search_response = response.text
-
-            # NON-OBVIOUS CHOICE: We parse the raw JavaScript to find the first URL
-            # in the 'urls' array. This is more robust than parsing HTML tags.
-            # It looks for `var urls = new Array('...url...')` and captures the URL.
-            match = re.search(r"var urls = new Array\('([^']+)'", search_response)
-            if not match:
-                self.log(f"Could not parse JS URL array for search term: '{search_term}'.")
-                return None
-            
-            movie_url = match.group(1)
-            self.log(f"Found movie page link from JS response: {movie_url}")
+            socket.gethostbyname('www.blu-ray.com')
+            self._net_ok = True
+            self._net_probe_fail_count = 0
+        except OSError as e:
+            # Often the network is simply not up yet at service start, so the host is
+            # re-probed soon, backing off exponentially like failed lookups do.
+            self._net_ok = False
+            self._net_probe_fail_count += 1
+            delay = min(NET_BACKOFF_MAX_S, 2 ** self._net_probe_fail_count)
+            self._net_reprobe_at = time.time() + delay
+            self.log("Cannot resolve blu-ray.com, pausing online lookups for %ss: %r", delay, e, level=xbmc.LOGWARNING)
+        return self._net_ok
 
-            # Now, fetch the content of the actual movie page.
-            response = self.session.get(movie_url, timeout=10)
+    def _search_streamed(self, url, pattern, anchor):
+        """
+        Downloads a page in chunks and returns the first match of a bytes pattern
+        (located via its anchor, see _search_anchored), closing the response as
+        soon as it is found. Movie pages are several hundred KB while the aspect
+        ratio sits in the specs block near the top, so most of the body is never
+        transferred or decoded. The price is that the connection is discarded,
+        unless the rest of the page is short enough to be drained.
+        """
+        with self._http.get(url, stream=True, timeout=HTTP_TIMEOUT) as response:
             response.raise_for_status()
-            movie_html = response.text
+            length = response.headers.get('Content-Length', '')
+            chunks = response.iter_content(chunk_size=16384)
+            tail = b''
+            for chunk in chunks:
+                # Keep a small overlap so a match split across two chunks is still found.
+                window = tail + chunk
+                match = _search_anchored(window, pattern, anchor)
+                if match:
+                    # raw.tell() counts bytes off the wire, like Content-Length does,
+                    # even when the body is compressed.
+                    if length.isdigit() and int(length) - response.raw.tell() <= _STREAM_DRAIN_MAX:
+                        for _ in chunks:
+                            pass
+                    return match
+                tail = window[-_STREAM_OVERLAP:]
+        return None
+
+    def _get_aspect_ratio_from_bluray_com(self, title, year, cancelled=None, movie_url=None):
+        """
+        Searches blu-ray.com and scrapes the aspect ratio. It uses an efficient
+        POST request and requires both a title and a year for accuracy.
+        If the optional `cancelled` event gets set while the search is running, or
+        the service shuts down, the remaining requests are skipped. If the movie page URL is already known
+        from an earlier lookup, the search request is skipped, unless that page
+        has since started failing with an HTTP error.
+        Returns an (aspect_ratio, movie_url) tuple. aspect_ratio is _NO_MATCH if the
+        site has no result for the title, or None if the lookup failed or was skipped.
+        """
+        search_term = f"{title} {year}"
+
+        if self._stopping.is_set() or (cancelled is not None and cancelled.is_set()):
+            return None, movie_url
 
-            # This regex specifically looks for the "Aspect ratio: X.XX:1" text on the page.
-            ar_match = re.search(r'Aspect ratio:\s*(\d+\.\d{2}):1', movie_html)
+        if not self._net_ok and (time.time() < self._net_reprobe_at or not self._probe_network()):
+            self.log("Skipping online search for '%s', blu-ray.com cannot be resolved.", search_term, level=xbmc.LOGDEBUG)
+            return None, movie_url
+
+        # After network failures, back off exponentially instead of hitting an
+        # unreachable site again on every playback.
+        if time.time() < self._net_cooldown_until:
+            self.log("Skipping online search for '%s' while backing off after network errors.", search_term, level=xbmc.LOGDEBUG)
+            return None, movie_url
+
+        from_cache = movie_url is not None
+        try:
+            if movie_url is None:
+                self.log("Attempting online search with term: '%s'", search_term, level=xbmc.LOGDEBUG)
+                # NON-OBVIOUS CHOICE: This uses a direct POST request to the search API,
+                # which returns a small, fast, and easy-to-parse JavaScript snippet
+                # instead of a full HTML page. This is much more efficient.
+                post_url = 'https://www.blu-ray.com/search/quicksearch.php'
+                post_data = {
+                    'section': 'bluraymovies',
+                    'userid': '-1',
+                    'country': 'US',
+                    'keyword': search_term
+                }
+                response = self._http.post(post_url, data=post_data, timeout=HTTP_TIMEOUT)
+                response.raise_for_status() # Raise an exception for bad status codes (4xx or 5xx)
+
+                # NON-OBVIOUS CHOICE: We parse the raw JavaScript to find the first URL
+                # in the 'urls' array. This is more robust than parsing HTML tags.
+                # It looks for `var urls = new Array('...url...')` and captures the URL.
+                # The snippet is tiny, so it is read in full: that lets the connection go
+                # back to the pool for the movie page request below.
+                match = _search_anchored(response.content, _RE_JS_URLS, _JS_URLS_ANCHOR)
+                if not match:
+                    self.log("Could not parse JS URL array for search term: '%s'.", search_term)
+                    self._net_fail_count = 0
+                    return _NO_MATCH, None
+
+                movie_url = match.group(1).decode('ascii')
+                self.log("Found movie page link from JS response: %s", movie_url, level=xbmc.LOGDEBUG)
+            else:
+                self.log("Using known movie page link for '%s': %s", search_term, movie_url, level=xbmc.LOGDEBUG)
+
+            if self._stopping.is_set() or (cancelled is not None and cancelled.is_set()):
+                self.log("Result is no longer needed. Skipping the movie page.", level=xbmc.LOGDEBUG)
+                return None, movie_url
+
+            # Now, fetch the actual movie page, stopping as soon as the
+            # "Aspect ratio: X.XX:1" text has gone past.
+            try:
+                ar_match = self._search_streamed(movie_url, _RE_ASPECT, _ASPECT_ANCHOR)
+            except requests.exceptions.HTTPError as e:
+                if not from_cache:
+                    raise
+                # A cached link can go stale (e.g. 404). Forget it and search again
+                # rather than retrying the dead page on every playback.
+                self.log("Known movie page %s failed (%r). Searching again.", movie_url, e, level=xbmc.LOGWARNING)
+                return self._get_aspect_ratio_from_bluray_com(title, year, cancelled)
             if not ar_match:
-                self.log(f"Could not find 'Aspect ratio' tag for search term: '{search_term}'.")
-                return None
+                self.log("Could not find 'Aspect ratio' tag for search term: '%s'.", search_term)
+                self._net_fail_count = 0
+                return _NO_MATCH, movie_url
 
-            aspect_ratio = float(ar_match.group(1))
-            self.log(f"Successfully scraped aspect ratio: {aspect_ratio}")
-            return aspect_ratio # Success! Exit the function with the result.
+            self._net_fail_count = 0
+            aspect_ratio = float(ar_match.group(1)) # float() parses the ASCII bytes directly.
+            self.log("Successfully scraped aspect ratio: %s", aspect_ratio)
+            return aspect_ratio, movie_url # Success! Exit the function with the result.
 
-        except requests.exceptions.RequestException as e:
-            self.log(f"A network error occurred during web scraping for '{search_term}': {e}", level=xbmc.LOGERROR)
+        except OSError as e:
+            # requests' exceptions derive from OSError, so this covers them as well as
+            # raw socket errors and timeouts surfacing while a streamed body is read.
+            self._net_fail_count += 1
+            self._net_cooldown_until = time.time() + min(NET_BACKOFF_MAX_S, 2 ** self._net_fail_count)
+            self.log("A network error occurred during web scraping for '%s': %r", search_term, e, level=xbmc.LOGERROR)
         except Exception as e:
-            self.log(f"An unexpected error occurred during web scraping for '{search_term}': {e}", level=xbmc.LOGERROR)
+            self.log("An unexpected error occurred during web scraping for '%s': %r", search_term, e, level=xbmc.LOGERROR)
         
-        self.log(f"Search attempt failed for '{search_term}'.")
-        return None
+        self.log("Search attempt failed for '%s'.", search_term)
+        return None, movie_url
     
     def onAVStarted(self):
         """
@@ -125,91 +524,165 @@ class AnamorphicPlayerMonitor(xbmc.Player):
         that the player is fully initialized and video stream details are available.
         This completely eliminates timing issues and the need for unreliable retry loops.
         """
-        self.log("onAVStarted event triggered. Analyzing video stream.")
+        # Bound once, as these are used repeatedly below.
+        log = self.log
+        info = xbmc.getInfoLabel
 
-        if not self.addon.getSettingBool('enable_autofit'):
-            self.log("Addon is disabled in settings. Skipping.")
-            return
-            
-        try:
-            target_ar_str = self.addon.getSetting('target_ar')
-            TARGET_SCREEN_AR = float(target_ar_str)
-            self.log(f"Using Target Screen AR from settings: {TARGET_SCREEN_AR}")
-        except (ValueError, TypeError):
-            TARGET_SCREEN_AR = 2.40
-            self.log(f"Could not parse Target AR setting. Falling back to default: {TARGET_SCREEN_AR}", level=xbmc.LOGWARNING)
+        self._refresh_debug_flag()
+        log("onAVStarted event triggered. Analyzing video stream.", level=xbmc.LOGDEBUG)
 
-        # --- UNIVERSAL METADATA LOGIC (InfoLabels) ---
-        # NON-OBVIOUS CHOICE: This is the most robust method. We read the same InfoLabels
-        # that the skin uses. By the time onAVStarted fires, Kodi's player state has
-        # been updated by any running metadata addons, making this data accurate.
-        is_tv_show = bool(xbmc.getInfoLabel('VideoPlayer.TVShowTitle'))
-        search_title = xbmc.getInfoLabel('VideoPlayer.TVShowTitle') or xbmc.getInfoLabel('Player.Title')
-        year = xbmc.getInfoLabel('VideoPlayer.Year')
-
-        self.log(f"Media identified via InfoLabels: Title='{search_title}', Year='{year}', IsTVShow={is_tv_show}")
-        
-        player_id = self.get_player_id()
-        if player_id is None: return
+        if self._monitor.settings_dirty:
+            self._monitor.settings_dirty = False
+            self._reload_settings()
 
-        # Get video stream properties to check the container aspect ratio.
-        player_props = self.execute_json_rpc("Player.GetProperties", {"playerid": player_id, "properties": ["videostreams"]})
-        if not (player_props and player_props.get("videostreams")):
-            self.log("Could not retrieve video stream details. Aborting.", level=xbmc.LOGWARNING)
+        if not self._enable_autofit:
+            log("Addon is disabled in settings. Skipping.")
             return
 
-        video_stream = player_props["videostreams"][0]
-        width, height = video_stream.get("width"), video_stream.get("height")
+        TARGET_SCREEN_AR = self._target_screen_ar
 
-        if not width or not height:
-            self.log("Video stream width or height is missing. Aborting.", level=xbmc.LOGWARNING)
+        # Kodi already reports the aspect ratio of the decoded stream. A natively wide
+        # encode (e.g. a 2.39:1 MKV) is not letterboxed inside a 16:9 container, so
+        # there is nothing to look up or adjust.
+        kodi_ar = _info_label_float('VideoPlayer.VideoAspect')
+        if kodi_ar is not None and kodi_ar >= 1.85:
+            log("Kodi reports a native %.2f:1 stream. No adjustments needed.", kodi_ar)
             return
 
-        video_ar = float(width) / float(height)
-        self.log(f"Video resolution: {width}x{height}, Container AR: {video_ar:.3f}")
+        # --- UNIVERSAL METADATA LOGIC (InfoLabels) ---
+        # NON-OBVIOUS CHOICE: This is the most robust method. We read the same InfoLabels
+        # that the skin uses. By the time onAVStarted fires, Kodi's player state has
+        # been updated by any running metadata addons, making this data accurate.
+        tv_show_title = info('VideoPlayer.TVShowTitle')
+        is_tv_show = bool(tv_show_title)
+        search_title = tv_show_title or info('Player.Title')
+        year = info('VideoPlayer.Year')
+
+        log("Media identified via InfoLabels: Title='%s', Year='%s', IsTVShow=%s", search_title, year, is_tv_show, level=xbmc.LOGDEBUG)
 
         # --- Early Exit Optimization ---
-        if not (1.77 < video_ar < 1.79):
-            self.log("Video container is not 16:9. No adjustments needed. Bailing out early.")
+        # The container is checked before the lookup is started, so non-16:9 sources
+        # never cause a request to blu-ray.com. The frame size normally comes from
+        # InfoLabels, so this check costs next to nothing.
+        video_ar = self._get_container_ar()
+        if video_ar is None or not (_CONTAINER_MIN < video_ar < _CONTAINER_MAX):
+            if video_ar is not None:
+                log("Video container is not 16:9. No adjustments needed. Bailing out early.")
             return
 
-        content_ar = self._get_aspect_ratio_from_bluray_com(search_title, year)
+        # The lookup runs on a worker thread. If playback stops or the wait times out,
+        # `cancelled` stops it before it makes any further requests to blu-ray.com.
+        cancelled = threading.Event()
+        lookup = self._executor.submit(self._lookup_aspect_ratio, search_title, year, cancelled)
+
+        # Wait for the lookup in short slices rather than one long blocking call, so
+        # that Kodi shutting down interrupts the handler right away.
+        # NON-OBVIOUS CHOICE: Kodi delivers player callbacks one at a time, so
+        # onPlayBackStopped cannot run while we wait here. Whether the video is still
+        # playing is therefore checked directly, and a lookup that finishes after the
+        # user stopped playback is dropped instead of zooming whatever plays next.
+        content_ar = None
+        deadline = time.monotonic() + LOOKUP_TIMEOUT_S
+        while True:
+            try:
+                content_ar = lookup.result(timeout=LOOKUP_WAIT_SLICE_S)
+                break
+            except FutureTimeoutError:
+                if self._monitor.abortRequested() or not self.isPlayingVideo():
+                    log("Playback ended before the aspect ratio lookup finished.", level=xbmc.LOGDEBUG)
+                    cancelled.set()
+                    return
+                if time.monotonic() >= deadline:
+                    log("Aspect ratio lookup did not finish within %ss.", LOOKUP_TIMEOUT_S, level=xbmc.LOGWARNING)
+                    cancelled.set()
+                    break
+            except Exception as e:
+                log("Aspect ratio lookup failed: %r", e, level=xbmc.LOGERROR)
+                return
 
         # If scraping fails, bail out. No fallback is used.
         if not content_ar:
-            self.log("Could not scrape aspect ratio, and no fallback is configured. No adjustments will be made.")
+            log("Could not scrape aspect ratio, and no fallback is configured. No adjustments will be made.")
             return
 
         # The final trigger condition.
-        if content_ar > video_ar + 0.01:
-            self.log("16:9 container with wider content detected. Applying anamorphic adjustments.")
-            
-            # --- CRITICAL FIX: The Smart Zoom Calculation ---
-            effective_ar = min(content_ar, TARGET_SCREEN_AR)
-            self.log(f"Using effective AR for zoom: {effective_ar:.3f} (min of Content AR {content_ar:.3f} and Screen AR {TARGET_SCREEN_AR:.3f})")
-            
-            zoom_factor = effective_ar / video_ar
-            ANAMORPHIC_PIXEL_RATIO = (16.0 / 9.0) / TARGET_SCREEN_AR
-
-            self.log(f"Calculated Zoom Factor: {zoom_factor:.3f}")
-            self.log(f"Applying Pixel Ratio: {ANAMORPHIC_PIXEL_RATIO:.4f}")
-
-            view_mode_params = {"viewmode": {"zoom": zoom_factor, "pixelratio": ANAMORPHIC_PIXEL_RATIO}}
-            self.execute_json_rpc("Player.SetViewMode", view_mode_params)
-            self.log("Custom view mode applied successfully.")
+        view_mode = _compute_view_mode(video_ar, content_ar, TARGET_SCREEN_AR)
+        if view_mode is not None:
+            log("16:9 container with wider content detected. Applying anamorphic adjustments.")
+            log("Content AR %.3f, Screen AR %.3f, Container AR %.3f", content_ar, TARGET_SCREEN_AR, video_ar, level=xbmc.LOGDEBUG)
+
+            zoom_factor, ANAMORPHIC_PIXEL_RATIO = view_mode
+
+            log("Calculated Zoom Factor: %.3f", zoom_factor, level=xbmc.LOGDEBUG)
+            log("Applying Pixel Ratio: %.4f", ANAMORPHIC_PIXEL_RATIO, level=xbmc.LOGDEBUG)
+
+            if self._set_view_mode(zoom_factor, ANAMORPHIC_PIXEL_RATIO):
+                log("Custom view mode applied successfully.")
         else:
-            self.log(f"No adjustment needed. Content AR ({content_ar:.3f}) is not wider than Container AR ({video_ar:.3f}).")
+            log("No adjustment needed. Content AR (%.3f) is not wider than Container AR (%.3f).", content_ar, video_ar)
 
     def onPlayBackStopped(self):
-        self.log("Playback stopped.")
+        self.log("Playback stopped.", level=xbmc.LOGDEBUG)
         pass
 
     def onPlayBackEnded(self):
         self.onPlayBackStopped()
 
-    def get_player_id(self):
-        """Finds the active video player ID."""
-        players = self.execute_json_rpc("Player.GetActivePlayers", {})
+    def shutdown(self):
+        """
+        Stops the background work when the service exits. Queued tasks are dropped
+        and a running lookup makes no further requests, so at most the request in
+        flight holds up interpreter shutdown, which joins the worker thread.
+        """
+        self._stopping.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _get_container_ar(self):
+        """
+        Returns the aspect ratio of the playing video stream's container, or None
+        if the stream details are not available.
+        """
+        # NON-OBVIOUS CHOICE: The decoder's frame size is exposed as InfoLabels, which are
+        # read in-process and are far cheaper than a JSON-RPC round trip. JSON-RPC is
+        # only used when Kodi does not report the size there.
+        width = _info_label_int('Player.Process(videowidth)')
+        height = _info_label_int('Player.Process(videoheight)')
+        if width and height:
+            video_ar = float(width) / float(height)
+            self.log("Video resolution: %sx%s, Container AR: %.3f", width, height, video_ar, level=xbmc.LOGDEBUG)
+            return video_ar
+
+        # NON-OBVIOUS CHOICE: The active players and the stream properties are fetched
+        # in one batch, optimistically assuming the usual video player id. Only if the
+        # video player turns out to have a different id is a second call needed.
+        stream_params = {"playerid": VIDEO_PLAYER_ID, "properties": ["videostreams"]}
+        results = self.execute_json_rpc_batch([
+            ("Player.GetActivePlayers", {}),
+            ("Player.GetProperties", stream_params),
+        ])
+        player_id = self._find_video_player_id(results.get(1))
+        if player_id is None: return None
+
+        player_props = results.get(2)
+        if player_id != VIDEO_PLAYER_ID:
+            player_props = self.execute_json_rpc("Player.GetProperties", dict(stream_params, playerid=player_id))
+        if not (player_props and player_props.get("videostreams")):
+            self.log("Could not retrieve video stream details. Aborting.", level=xbmc.LOGWARNING)
+            return None
+
+        video_stream = player_props["videostreams"][0]
+        width, height = video_stream.get("width"), video_stream.get("height")
+
+        if not width or not height:
+            self.log("Video stream width or height is missing. Aborting.", level=xbmc.LOGWARNING)
+            return None
+
+        video_ar = float(width) / float(height)
+        self.log("Video resolution: %sx%s, Container AR: %.3f", width, height, video_ar, level=xbmc.LOGDEBUG)
+        return video_ar
+
+    def _find_video_player_id(self, players):
+        """Picks the video player ID out of a Player.GetActivePlayers result."""
         if players:
             for player in players:
                 if player["type"] == "video":
@@ -218,13 +691,11 @@ class AnamorphicPlayerMonitor(xbmc.Player):
         return None
 
 if __name__ == '__main__':
-    player_monitor = AnamorphicPlayerMonitor()
+    monitor = AnamorphicSettingsMonitor()
+    player_monitor = AnamorphicPlayerMonitor(monitor)
     
-    # The monitor loop's only job is to keep the addon running.
-    # All logic is now handled by the event-driven Player class.
-    monitor = xbmc.Monitor()
-    while not monitor.abortRequested():
-        if monitor.waitForAbort(10):
-            break
-            
-    del player_monitor
+    # The monitor's only job is to keep the addon running.
+    # All logic is now handled by the event-driven Player class, so nothing
+    # needs to wake up periodically: simply block until Kodi asks us to exit.
+    monitor.waitForAbort()
+    player_monitor.shutdown()